@@ -1,13 +1,18 @@
-from rwtools.graphtools.solvers import direct_solver, solve_cg, solve_cg_mg,\
-    solve_gpu, cholesky_solver, mp_cg, mp_cg_ichol, sp_cg, sp_cg_ichol
+from rwtools.graphtools.solvers import direct_solver, solve_cg, solve_cg_mg, solve_amg, solve_cg_stencil,\
+    solve_gpu, solve_gpu_cg, cholesky_solver, mp_cg, mp_cg_ichol, sp_cg, sp_cg_ichol
 
 solvers = {"direct": direct_solver,
            "cholesky": cholesky_solver,
            "cg_mg": solve_cg_mg,
+           "amg": solve_amg,
            "cg": solve_cg,
            "cuda": solve_gpu,
+           "cuda_cg": solve_gpu_cg,
            "mp_cg": mp_cg,
            "mp_cg_ichol": mp_cg_ichol,
            "sp_cg": sp_cg,
            "sp_cg_ichol": sp_cg_ichol
            }
+
+# solvers working on the matrix-free lattice Laplacian (see stencil_lapu_b), they do not accept an assembled matrix
+matrix_free_solvers = {"cg_stencil": solve_cg_stencil}
@@ -0,0 +1,110 @@
+import cupy as cp
+import cupyx.scipy.sparse
+import numpy as np
+
+_cg_columns_source = r'''
+__device__ float block_sum(float value, float* buffer)
+{
+    buffer[threadIdx.x] = value;
+    __syncthreads();
+    for (int s = blockDim.x / 2; s > 0; s >>= 1) {
+        if (threadIdx.x < s) {
+            buffer[threadIdx.x] += buffer[threadIdx.x + s];
+        }
+        __syncthreads();
+    }
+    float out = buffer[0];
+    __syncthreads();
+    return out;
+}
+
+extern "C" __global__
+void cg_columns(const float* a_data, const int* a_indices, const int* a_indptr, const float* inv_diag,
+                const float* b, float* x, float* r, float* z, float* p, float* a_p,
+                const int n, const float tol, const int max_iteration)
+{
+    // one thread block solves one column, all the vectors are column-major (n x k)
+    __shared__ float buffer[256];
+    const long offset = (long)blockIdx.x * n;
+    b += offset; x += offset; r += offset; z += offset; p += offset; a_p += offset;
+
+    float rz = 0.f, bb = 0.f;
+    for (int i = threadIdx.x; i < n; i += blockDim.x) {
+        x[i] = 0.f;
+        r[i] = b[i];
+        z[i] = b[i] * inv_diag[i];
+        p[i] = z[i];
+        rz += r[i] * z[i];
+        bb += b[i] * b[i];
+    }
+    rz = block_sum(rz, buffer);
+    float rr = block_sum(bb, buffer);
+    const float tol_sq = tol * tol * rr;
+
+    for (int it = 0; it < max_iteration && rr > tol_sq; it++) {
+        float pap = 0.f;
+        for (int i = threadIdx.x; i < n; i += blockDim.x) {
+            float _ap = 0.f;
+            for (int j = a_indptr[i]; j < a_indptr[i + 1]; j++) {
+                _ap += a_data[j] * p[a_indices[j]];
+            }
+            a_p[i] = _ap;
+            pap += p[i] * _ap;
+        }
+        const float alpha = rz / block_sum(pap, buffer);
+
+        float rz_new = 0.f;
+        rr = 0.f;
+        for (int i = threadIdx.x; i < n; i += blockDim.x) {
+            x[i] += alpha * p[i];
+            r[i] -= alpha * a_p[i];
+            z[i] = r[i] * inv_diag[i];
+            rr += r[i] * r[i];
+            rz_new += r[i] * z[i];
+        }
+        rr = block_sum(rr, buffer);
+        rz_new = block_sum(rz_new, buffer);
+
+        const float beta = rz_new / rz;
+        rz = rz_new;
+        for (int i = threadIdx.x; i < n; i += blockDim.x) {
+            p[i] = z[i] + beta * p[i];
+        }
+        __syncthreads();
+    }
+}
+'''
+
+_cg_columns_kernel = cp.RawKernel(_cg_columns_source, 'cg_columns')
+
+
+def cg_columns(A, b, tol=1.e-3, max_iteration=None, pre_conditioner=True):
+    """Solves Ax = b for all the columns of b with a single fused CUDA kernel.
+    Every thread block runs the whole Jacobi pre-conditioned conjugate gradient of one column:
+    SpMV, vector updates and dot products never leave the kernel, therefore a single launch is needed.
+    It is meant for small grids, where the cg is bound by the kernel launch latency.
+    Args:
+        A (cupyx.scipy.sparse.csr_matrix): The input symmetric positive definite matrix
+            with dimension ``(N, N)``
+        b (cupy.ndarray): Right-hand side matrix with dimension ``(N, K)``.
+        tol (float): relative tolerance, a column stops once ``||b - Ax|| <= tol * ||b||``.
+        max_iteration (int): maximum number of iterations, default ``10 * N``.
+        pre_conditioner (bool): if false no pre-conditioner is used.
+    Returns:
+        cupy.ndarray: The solution ``x`` with dimension ``(N, K)``.
+    """
+    if not cupyx.scipy.sparse.isspmatrix_csr(A):
+        A = cupyx.scipy.sparse.csr_matrix(A)
+
+    n, k = b.shape
+    max_iteration = 10 * n if max_iteration is None else max_iteration
+
+    a_data = A.data.astype(np.float32)
+    inv_diag = 1 / A.diagonal().astype(np.float32) if pre_conditioner else cp.ones(n, dtype=np.float32)
+    b = cp.asfortranarray(b, dtype=np.float32)
+    x, r, z, p, a_p = [cp.empty((n, k), dtype=np.float32, order='F') for _ in range(5)]
+
+    _cg_columns_kernel((k,), (256,), (a_data, A.indices.astype(np.int32), A.indptr.astype(np.int32), inv_diag,
+                                      b, x, r, z, p, a_p,
+                                      np.int32(n), np.float32(tol), np.int32(max_iteration)))
+    return x
@@ -1,7 +1,8 @@
 import numpy as np
 from scipy.sparse import csc_matrix, diags, eye
 
-from rwtools.graphtools import solvers
+from rwtools.graphtools import solvers, matrix_free_solvers
+from rwtools.graphtools.stencil import stencil_lapu_b
 from rwtools.utils import lap2lapu_bt, sparse_pm, pu2p
 
 
@@ -251,11 +252,16 @@ def edges_tensor2graph(edges_tensor, image_shape, offsets):
 
 
 def compute_randomwalker(edges, graph, seeds_mask, solving_mode="direct", num_workers=None):
-    A = graph2adjacency(graph, edges)
-    L = adjacency2laplacian(A, mode=0)
-    Lu, Bt = lap2lapu_bt(L, seeds_mask)
-    pm = sparse_pm(seeds_mask)
-    pu = solvers[solving_mode](Lu, Bt.dot(pm), max_workers=num_workers)
+    if solving_mode in matrix_free_solvers:  # the laplacian is applied as a stencil, never assembled
+        Lu, b = stencil_lapu_b(graph, edges, seeds_mask)
+        pu = matrix_free_solvers[solving_mode](Lu, b, max_workers=num_workers)
+    else:
+        A = graph2adjacency(graph, edges)
+        L = adjacency2laplacian(A, mode=0)
+        Lu, Bt = lap2lapu_bt(L, seeds_mask)
+        b = Bt.dot(sparse_pm(seeds_mask))
+        pu = solvers[solving_mode](Lu, b, max_workers=num_workers)
+
     pu = np.array(pu, dtype=np.float32) if type(pu) == np.ndarray else np.array(pu.toarray(), dtype=np.float32)
     p = pu2p(pu, seeds_mask)
     return p
\ No newline at end of file
@@ -134,17 +134,128 @@ def _dot(x, y):
     return _res
 
 
-@numba.jit(nogil=True)
-def _cg(input):
-    (b,
-     a_value,
-     a_indices,
-     a_indptr,
-     a_shape,
-     x,
-     tol,
-     max_iteration) = input
+def to_ell(data, indices, indptr, max_nnz_per_row=None):
+    """
+    Converts a csr matrix to the ELLPACK format: every row is padded to the same number of entries,
+    the padding points to the diagonal with a zero value.
+    Returns values (N x K) and columns (N x K)
+    """
+    n, row_nnz = indptr.shape[0] - 1, np.diff(indptr)
+    k = row_nnz.max() if max_nnz_per_row is None else max_nnz_per_row
+    assert row_nnz.max() <= k, "max_nnz_per_row is smaller than the number of entries of a row"
+
+    rows = np.repeat(np.arange(n), row_nnz)
+    position = np.arange(indices.shape[0]) - np.repeat(indptr[:-1], row_nnz)
+
+    values = np.zeros((n, k), dtype=data.dtype)
+    columns = np.repeat(np.arange(n, dtype=np.int32)[:, None], k, axis=1)
+    values[rows, position] = data
+    columns[rows, position] = indices
+    return values, columns
+
+
+@numba.njit(parallel=True,
+            fastmath=True,
+            cache=True)
+def ell_dot(values, columns, b, x):
+    for i in numba.prange(b.shape[0]):
+        _x = 0.0
+        for k in range(values.shape[1]):
+            _x += values[i, k] * b[columns[i, k]]
+
+        x[i] = _x
+    return x
+
+
+@numba.njit(parallel=True,
+            fastmath=True,
+            cache=True)
+def stencil_dot(deltas, weights, degree, mask_u, x, y):
+    """
+    y = Lu x for the Laplacian of a lattice graph, without any index array. Lu is kept on the full lattice:
+    the unseeded rows see only the unseeded nodes and the seeded rows are the identity.
+    The edge (i, i + deltas[k]) has weight weights[k, i], missing edges have zero weight. x and y are (N x K) blocks,
+    the columns are the outer loop so that column-major blocks are read contiguously.
+    """
+    n = x.shape[0]
+    for c in range(x.shape[1]):
+        for i in numba.prange(n):
+            if not mask_u[i]:
+                y[i, c] = x[i, c]
+                continue
+
+            _y = degree[i] * x[i, c]
+            for k in range(deltas.shape[0]):
+                j = i + deltas[k]
+                if j < n and mask_u[j]:
+                    _y -= weights[k, i] * x[j, c]
+
+                j = i - deltas[k]
+                if j >= 0 and mask_u[j]:
+                    _y -= weights[k, j] * x[j, c]
+
+            y[i, c] = _y
+    return y
+
+
+@numba.njit(fastmath=True,
+            cache=True)
+def _cg_update(x, r, p, a_p, alpha):
+    """ Fused x += alpha * p, r -= alpha * a_p and r dot r, a single pass over the cg vectors."""
+    _res = 0.0
+    for i in range(x.shape[0]):
+        x[i] += alpha * p[i]
+        r[i] -= alpha * a_p[i]
+        _res += r[i] * r[i]
+
+    return _res
+
+
+@numba.njit(fastmath=True,
+            cache=True)
+def _xpby(x, y, beta):
+    """ In place y = x + beta * y"""
+    for i in range(x.shape[0]):
+        y[i] = x[i] + beta * y[i]
+
+    return y
+
+
+@numba.njit(parallel=True,
+            fastmath=True,
+            cache=True)
+def _cg_fused(b, a_values, a_columns, tol, max_iteration):
+    """
+    Conjugate gradient with the whole iteration compiled, vector updates and dot products are fused.
+    A is given in ELLPACK format (see to_ell), it stops when ||b - Ax|| <= tol * ||b||
+    """
+    x = np.zeros(b.shape[0])
+    r = b.astype(np.float64)
+    p = r.copy()
+    a_p = np.empty_like(r)
 
+    r_old = _dot(r, r)
+    tol_sq = tol * tol * r_old
+    for _ in range(max_iteration):
+        if r_old <= tol_sq:
+            break
+
+        ell_dot(a_values, a_columns, p, a_p)
+
+        alpha = r_old / _dot(p, a_p)
+        r_new = _cg_update(x, r, p, a_p, alpha)
+
+        _xpby(r, p, r_new / r_old)
+        r_old = r_new
+
+    return x
+
+
+@numba.jit(nopython=True,
+           fastmath=True,
+           nogil=True)
+def _cg_column(b, a_value, a_indices, a_indptr, x, tol, max_iteration):
+    """ Conjugate gradient on a single right hand side starting from x, it stops when ||b - Ax|| < tol."""
     r = b - sp_dot(a_value, a_indices, a_indptr, x)
     p = r
     r_old = _dot(r, r)
@@ -168,6 +279,41 @@ def _cg(input):
     return x
 
 
+@numba.jit(nogil=True)
+def _cg(input):
+    (b,
+     a_value,
+     a_indices,
+     a_indptr,
+     a_shape,
+     x,
+     tol,
+     max_iteration) = input
+
+    return _cg_column(b, a_value, a_indices, a_indptr, x, tol, max_iteration)
+
+
+@numba.njit(parallel=True,
+            cache=True,
+            fastmath=True)
+def _cg_csc_columns(b_data, b_indices, b_indptr, n_cols, a_value, a_indices, a_indptr, tol, max_iteration):
+    """
+    Conjugate gradient over all the columns of a sparse csc right hand side, the columns are solved in parallel.
+    Returns x array (n_cols x N)
+    """
+    n = a_indptr.shape[0] - 1
+    x_all = np.empty((n_cols, n))
+    for j in numba.prange(n_cols):
+        # scatter the sparse column to a thread local dense vector
+        b = np.zeros(n)
+        for k in range(b_indptr[j], b_indptr[j + 1]):
+            b[b_indices[k]] = b_data[k]
+
+        x_all[j] = _cg_column(b, a_value, a_indices, a_indptr, np.zeros(n) + 1 / n_cols, tol, max_iteration)
+
+    return x_all
+
+
 @numba.jit(nogil=True)
 def _cg_ichol_preconditioned(input):
     (b,
@@ -1,16 +1,18 @@
+import copy
 import warnings
 
 import numpy as np
-from scipy.sparse import csr_matrix, coo_matrix, tril
-from scipy.sparse.linalg import cg
-from scipy.sparse.linalg import spsolve
+from scipy.sparse import csr_matrix, csc_matrix, coo_matrix, tril, isspmatrix_csr, isspmatrix_csc
+from scipy.sparse.linalg import splu, LinearOperator
 
 from concurrent import futures
-from rwtools.graphtools.numba_cg import ichol_csc, csc2csr, _cg, _cg_ichol_preconditioned
+from rwtools.graphtools.numba_cg import ichol_csc, csc2csr, _cg, _cg_csc_columns, _cg_fused, \
+    _cg_ichol_preconditioned, to_ell
 import multiprocessing
 
 try:
     import pyamg
+    from pyamg.relaxation.smoothing import change_smoothers
     use_direct_solver_mg = False
 
 except ImportError:
@@ -19,9 +21,10 @@ except ImportError:
     use_direct_solver_mg = True
 
 try:
-    from rwtools.graphtools.chol_cupy import chol
     import cupy as cp
     import cupyx.scipy.sparse
+    import cupyx.scipy.sparse.linalg
+    from rwtools.graphtools.cg_cupy import cg_columns
     use_direct_solver_cupy = False
 
 except ImportError:
@@ -36,10 +39,29 @@ except ImportError:
     warnings.warn("sksparse. Reverting to direct solver.")
     use_cholesky = True
 
+# Ruge Stuben interpolation operators, keyed by the sparsity structure of A
+_AMG_CACHE, _AMG_CACHE_SIZE = {}, 4
+
 
 def direct_solver(A, b, max_workers=None):
-    """ Simple wrapper around scipy spsolve """
-    return spsolve(A, b, use_umfpack=True)
+    """
+    This function solves the linear system of equations: Ax = b, using the SuperLU decomposition of scipy.
+    A is factorized once and all the columns of b are solved together. The minimum degree ordering on A^T+A
+    gives much sparser factors than the default COLAMD for the symmetric lattice Laplacians.
+    Parameters
+    ----------
+    A: Sparse csc matrix (NxN)
+    b: Sparse array or array (NxM)
+
+    returns x array (NxM)
+    -------
+    """
+    # factorized in double precision, as spsolve did by upcasting A to the dtype of b
+    A = A if isspmatrix_csc(A) and A.dtype == np.float64 else csc_matrix(A, dtype=np.float64)
+    b = b if type(b) == np.ndarray else b.toarray()
+
+    A_lu = splu(A, permc_spec='MMD_AT_PLUS_A')
+    return A_lu.solve(np.asarray(b, dtype=np.float64))
 
 
 def cholesky_solver(A, b, max_workers=None):
@@ -47,19 +69,16 @@ def cholesky_solver(A, b, max_workers=None):
     if use_cholesky:
         return direct_solver(A, b)
 
-    A_solver, x = cholesky(A), []
+    A_solver = cholesky(A)
 
-    for i in range(b.shape[-1]):
-        _x = A_solver.solve_A(b[:, i])
-        _x = np.array(_x, dtype=np.float32) if type(_x) == np.ndarray else np.array(_x.toarray(), dtype=np.float32)
-        x.append(_x)
-
-    return np.concatenate(x, axis=1)
+    # CHOLMOD solves the whole right hand side at once, it works in double precision internally
+    b = np.asarray(b if type(b) == np.ndarray else b.toarray(), dtype=np.float64, order='F')
+    return A_solver.solve_A(b).astype(np.float32)
 
 
 def mp_cg(A, b, tol=1.e-3, use_preconditioner=False, max_workers=None):
     """Experimental"""
-    acsr = csr_matrix(A)
+    acsr = A if isspmatrix_csr(A) else csr_matrix(A)
     a_value = acsr.data
     a_shape = acsr.shape
     a_indptr = acsr.indptr
@@ -103,9 +122,11 @@ def mp_cg(A, b, tol=1.e-3, use_preconditioner=False, max_workers=None):
                      int(1e6)) for i in range(b.shape[-1])]
 
     _solver = _cg_ichol_preconditioned if use_preconditioner else _cg
-    _x = executor.map(_solver, iterator)
-    x = list(_x)
-    return np.array(x).reshape(b.shape[-1], -1).T
+    x = np.empty((a_shape[0], b.shape[-1]), order='F')
+    for i, _x in enumerate(executor.map(_solver, iterator)):
+        x[:, i] = _x
+
+    return x
 
 
 def mp_cg_ichol(A, b, tol=1.e-3, use_preconditioner=True, max_workers=None):
@@ -114,32 +135,30 @@ def mp_cg_ichol(A, b, tol=1.e-3, use_preconditioner=True, max_workers=None):
 
 def sp_cg(A, b, tol=1.e-3, max_workers=None):
     """Experimental"""
-    acsr = csr_matrix(A)
+    acsr = A if isspmatrix_csr(A) else csr_matrix(A)
     a_value = acsr.data
-    a_shape = acsr.shape
     a_indptr = acsr.indptr
     a_indices = acsr.indices
 
-    b = np.array(b.todense())
+    # the columns of b are scattered to dense vectors inside the solver threads
+    b = csc_matrix(b)
 
-    x = []
-    for i in range(b.shape[-1]):
-        _x = _cg((b[:, i].ravel(),
-                 a_value,
-                 a_indices,
-                 a_indptr,
-                 a_shape,
-                 np.zeros(a_shape[0]) + 1/b.shape[-1],
-                 tol,
-                 int(1e6)))
-        x.append(_x)
+    x = _cg_csc_columns(b.data.astype(np.float64),
+                        b.indices,
+                        b.indptr,
+                        b.shape[-1],
+                        a_value,
+                        a_indices,
+                        a_indptr,
+                        tol,
+                        int(1e6))
 
-    return np.array(x).reshape(b.shape[-1], -1).T
+    return x.T
 
 
 def sp_cg_ichol(A, b, tol=1.e-3, max_workers=None):
     """Experimental"""
-    acsr = csr_matrix(A)
+    acsr = A if isspmatrix_csr(A) else csr_matrix(A)
     a_value = acsr.data
     a_shape = acsr.shape
     a_indptr = acsr.indptr
@@ -147,7 +166,7 @@ def sp_cg_ichol(A, b, tol=1.e-3, max_workers=None):
 
     b = np.array(b.todense())
 
-    x = []
+    x = np.empty((a_shape[0], b.shape[-1]), order='F')
     A_l = tril(A, format="csc")
     ichol_value = ichol_csc(A_l.data.copy(), A_l.indices, A_l.indptr, A_l.shape[0])
     ichol_value, ichol_indices, ichol_indptr, ichol_shape = csc2csr(ichol_value,
@@ -168,8 +187,32 @@ def sp_cg_ichol(A, b, tol=1.e-3, max_workers=None):
                                       np.zeros(a_shape[0]) + 1 / b.shape[-1],
                                       tol,
                                       int(1e6)))
-        x.append(_x)
-    return np.array(x).reshape(b.shape[-1], -1).T
+        x[:, i] = _x
+    return x
+
+
+def solve_partition_of_unity(solve, b, num_nodes=None, dtype=None, order='C'):
+    """
+    The random walker probabilities sum to one on every node: only the first M-1 columns of b are solved,
+    the last one is recovered from the partition of unity.
+    Parameters
+    ----------
+    solve: function solve(b, x), it writes the solution of the M-1 columns of b in x
+    b: Sparse array or array (NxM)
+    num_nodes: number of rows of the solution, default N
+    dtype: dtype of the dense b passed to solve, default the dtype of b
+    order: memory layout of b and x
+
+    returns x array (num_nodes x M)
+    -------
+    """
+    b = b[:, :-1]
+    b = np.asarray(b if type(b) == np.ndarray else b.toarray(order=order), dtype=dtype, order=order)
+
+    pu = np.empty((b.shape[0] if num_nodes is None else num_nodes, b.shape[-1] + 1), dtype=np.float32, order=order)
+    solve(b, pu[:, :-1])
+    pu[:, -1] = 1 - pu[:, :-1].sum(axis=1)
+    return pu
 
 
 def solve_cg_mg(A, b, tol=1.e-3, pre_conditioner=True, max_workers=None):
@@ -188,41 +231,191 @@ def solve_cg_mg(A, b, tol=1.e-3, pre_conditioner=True, max_workers=None):
     returns x array (NxM)
     -------
     """
-    pu = []
-    A = csr_matrix(A)
+    if use_direct_solver_mg:
+        return solve_cg(A, b, tol=tol)
 
-    # The actual cast will be performed slice by slice to reduce memory footprint
-    check_type = True if type(b) == np.ndarray else False
+    A = A if isspmatrix_csr(A) else csr_matrix(A)
 
     # pre-conditioner
-    if pre_conditioner and not use_direct_solver_mg:
-        M = mg_preconditioner(A)
-    else:
-        M = None
+    M = mg_preconditioner(A) if pre_conditioner else None
+
+    def _solve(_b, x):
+        x[...] = block_cg(A, _b, tol=tol, M=M)
+
+    return solve_partition_of_unity(_solve, b, dtype=np.float32)
+
+
+def solve_amg(A, b, tol=1.e-3, max_workers=None):
+    """
+    It solves the linear system of equations: Ax = b, directly with the Ruge Stuben multigrid solver.
+    The cg acceleration runs inside pyamg, no outer scipy cg is used.
+    Parameters
+    ----------
+    A: Sparse csr matrix (NxN)
+    b: Sparse array or array (NxM)
+    tol: result tolerance
+    max_workers: number of threads solving the columns, default 1
+
+    returns x array (NxM)
+    -------
+    """
+    if use_direct_solver_mg:
+        return direct_solver(A, b)
+
+    A = A if isspmatrix_csr(A) else csr_matrix(A)
+    ml = mg_solver(A)
+
+    def _solve(_b, x):
+        def _solve_columns(_ml, columns):
+            for i in columns:
+                x[:, i] = _ml.solve(_b[:, i], tol=tol, accel='cg', maxiter=100)
+
+        # the columns are independent, but whether the threads overlap depends on how much of the pyamg solve runs
+        # outside the GIL, therefore the columns are solved serially unless more workers are requested.
+        # The hierarchy holds mutable work buffers, every thread gets its own copy
+        _max_workers = max(min(1 if max_workers is None else max_workers, _b.shape[-1]), 1)
+        all_ml = [ml] + [copy.deepcopy(ml) for _ in range(_max_workers - 1)]
+        all_columns = np.array_split(np.arange(_b.shape[-1]), _max_workers)
+
+        with futures.ThreadPoolExecutor(max_workers=_max_workers) as executor:
+            list(executor.map(_solve_columns, all_ml, all_columns))
+
+    # column-major, every column of b and of the output is a contiguous view
+    return solve_partition_of_unity(_solve, b, dtype=np.float32, order='F')
+
+
+def mg_solver(A):
+    """
+    Builds the Ruge Stuben hierarchy of A. The interpolation operators are cached by the sparsity structure of A:
+    in a pipeline the graph topology is the same for every image and only the edge weights change, therefore on a
+    cache hit the C/F splitting is skipped and only the Galerkin coarse operators R A P are recomputed.
+    The dtype is part of the key, so that all the levels of a hierarchy share the precision of A.
+    """
+    key = (A.shape, A.dtype, A.nnz, hash(A.indptr.tobytes()), hash(A.indices.tobytes()))
+
+    if key not in _AMG_CACHE:
+        ml = pyamg.ruge_stuben_solver(A, coarse_solver='gauss_seidel')
+        if len(_AMG_CACHE) >= _AMG_CACHE_SIZE:
+            del _AMG_CACHE[next(iter(_AMG_CACHE))]
+
+        _AMG_CACHE[key] = [(level.P, level.R) for level in ml.levels[:-1]]
+        return ml
 
-    _pu_sum = np.ones(b.shape[0], dtype=np.float32)
-    for i in range(b.shape[-1] - 1):
-        _b = b[:, i].astype(np.float32) if check_type else b[:, i].todense().astype(np.float32)
-        _pu = cg(A, _b, tol=tol, M=M)[0].astype(np.float32)
-        _pu_sum -= _pu
-        pu.append(_pu)
+    levels = [pyamg.MultilevelSolver.Level()]
+    levels[-1].A = A.asfptype()
+    for P, R in _AMG_CACHE[key]:
+        levels[-1].P, levels[-1].R = P, R
+        levels.append(pyamg.MultilevelSolver.Level())
+        levels[-1].A = R @ levels[-2].A @ P
 
-    pu.append(_pu_sum)
-    return np.array(pu, dtype=np.float32).T
+    ml = pyamg.MultilevelSolver(levels, coarse_solver='gauss_seidel')
+    change_smoothers(ml, presmoother=('gauss_seidel', {'sweep': 'symmetric'}),
+                     postsmoother=('gauss_seidel', {'sweep': 'symmetric'}))
+    return ml
 
 
 def mg_preconditioner(A):
-    ml = pyamg.ruge_stuben_solver(A, coarse_solver='gauss_seidel')
+    ml = mg_solver(A)
     M = ml.aspreconditioner(cycle='V')
     return M
 
 
+def solve_cg_stencil(A, b, tol=1.e-3, pre_conditioner=True, max_workers=None):
+    """
+    It solves the linear system of equations: Ax = b, by block conjugate gradient with a Jacobi pre-conditioner.
+    Meant for the matrix-free lattice Laplacian (see stencil_lapu_b), A is never assembled.
+    Parameters
+    ----------
+    A: StencilLinearOperator, defined on all the lattice nodes (N_all x N_all)
+    b: array (N_all x M), zero on the seeds
+    tol: result tolerance
+    pre_conditioner: if false no pre-conditioner is used
+
+    returns x array (NxM), restricted to the unseeded nodes
+    -------
+    """
+    M = jacobi_preconditioner(A) if pre_conditioner else None
+
+    def _solve(_b, x):
+        x[...] = block_cg(A, _b, tol=tol, M=M)[A.mask_u]
+
+    return solve_partition_of_unity(_solve, b, num_nodes=int(A.mask_u.sum()))
+
+
+def block_cg(A, B, M=None, tol=1.e-3, maxiter=None):
+    """
+    Pseudo-block conjugate gradient: solves the linear system of equations AX = B for all the columns of B at once.
+    Every column follows its own CG recurrence, but A and M are applied to the whole block of active columns,
+    so that the matrix is read from memory once per iteration instead of once per column.
+    Parameters
+    ----------
+    A: Sparse csr matrix or LinearOperator (NxN), scipy or cupyx
+    B: array (NxK), numpy or cupy. If B is a cupy array the whole solve stays on the device.
+    M: pre-conditioner (LinearOperator), if None no pre-conditioner is used
+    tol: relative tolerance, a column stops updating once ||b - Ax|| <= tol * ||b||
+    maxiter: maximum number of iterations, default 10 * N
+
+    returns X array (NxK)
+    -------
+    """
+    xp = np if use_direct_solver_cupy else cp.get_array_module(B)
+    dtype = np.result_type(A.dtype, B.dtype, np.float32)
+    maxiter = 10 * A.shape[0] if maxiter is None else maxiter
+    X_out = xp.zeros(B.shape, dtype=dtype)
+
+    # only the columns still converging are kept in the working block
+    b_norm = xp.linalg.norm(B, axis=0)
+    cols = xp.flatnonzero(b_norm > 0)
+    tol_sq = (tol * b_norm[cols]) ** 2
+
+    # column-major blocks keep every column contiguous for the element-wise updates
+    X = xp.zeros((B.shape[0], cols.size), dtype=dtype, order='F')
+    R = xp.asfortranarray(B[:, cols], dtype=dtype)
+    Z = R if M is None else xp.asfortranarray(M.matmat(R), dtype=dtype)
+    P = Z.copy(order='F')
+    rz = xp.einsum('ij,ij->j', R, Z)
+
+    for _ in range(maxiter):
+        if cols.size == 0:
+            break
+
+        AP = xp.asfortranarray(A @ P)
+        alpha = rz / xp.einsum('ij,ij->j', P, AP)
+        X += P * alpha
+        AP *= alpha
+        R -= AP
+
+        # per-column convergence mask, converged columns are stored and dropped from the block
+        rr = xp.einsum('ij,ij->j', R, R)
+        converged = rr <= tol_sq
+        if converged.any():
+            X_out[:, cols[converged]] = X[:, converged]
+            keep = ~converged
+            cols, tol_sq, rz, rr = cols[keep], tol_sq[keep], rz[keep], rr[keep]
+            X, R, P = X[:, keep], R[:, keep], P[:, keep]
+            if cols.size == 0:
+                break
+
+        if M is None:
+            Z, _rz = R, rr
+        else:
+            Z = xp.asfortranarray(M.matmat(R), dtype=dtype)
+            _rz = xp.einsum('ij,ij->j', R, Z)
+
+        P *= _rz / rz
+        P += Z
+        rz = _rz
+
+    X_out[:, cols] = X
+    return X_out
+
+
 def solve_cg(A, b, tol=1.e-3, max_workers=None):
     """
     Implementation follows the source code of skimage:
     https://github.com/scikit-image/scikit-image/blob/master/skimage/segmentation/random_walker_segmentation.py
     it solves the linear system of equations: Ax = b,
-    by conjugate gradient
+    by conjugate gradient. The full cg iteration is compiled with numba.
     Parameters
     ----------
     A: Sparse csr matrix (NxN)
@@ -232,15 +425,41 @@ def solve_cg(A, b, tol=1.e-3, max_workers=None):
     returns x array (NxM)
     -------
     """
-    return solve_cg_mg(A, b, tol=tol, pre_conditioner=None)
+    A = A if isspmatrix_csr(A) else csr_matrix(A)
+
+    # the random walker laplacian has a bounded degree, the padded ELLPACK layout gives a regular spmv
+    a_values, a_columns = to_ell(A.data, A.indices, A.indptr)
+
+    def _solve(_b, x):
+        for i in range(_b.shape[-1]):
+            x[:, i] = _cg_fused(_b[:, i], a_values, a_columns, tol, 10 * A.shape[0])
+
+    return solve_partition_of_unity(_solve, b, dtype=np.float32, order='F')
+
+
+def to_gpu_pinned(x, stream, dtype=None, order='C'):
+    """
+    Copies x to the GPU through a page-locked host buffer, the copy is issued asynchronously on stream.
+    The pinned buffer is returned together with the device array: it must be kept alive until the stream is synchronized.
+    """
+    dtype = x.dtype if dtype is None else dtype
+    x_pinned = cupyx.empty_pinned(x.shape, dtype=dtype, order=order)
+    x_pinned[...] = x
+
+    x_gpu = cp.empty(x.shape, dtype=dtype, order=order)
+    x_gpu.set(x_pinned, stream=stream)
+    return x_gpu, x_pinned
 
 
 def solve_gpu(A, b, max_workers=None):
     """
-    This function solves the linear system of equations: Ax = b, using chlomod solver on the GPU.
+    This function solves the linear system of equations: Ax = b, using a LU decomposition and GPU triangular solves.
+    The factorization runs on the host with SuperLU (as cupyx splu does internally), with the minimum degree
+    ordering on A^T+A that keeps the factors sparse. Only L, U and b are moved to the device, and all the columns
+    of b are solved with a single batched triangular solve.
     Parameters
     ----------
-    A: Sparse csr matrix (NxN)s
+    A: Sparse csc matrix (NxN)
     b: Sparse array or array (NxM)
 
     returns x array (NxM)
@@ -249,20 +468,77 @@ def solve_gpu(A, b, max_workers=None):
     if use_direct_solver_cupy:
         return direct_solver(A, b)
 
-    # The actual cast will be performed slice by slice to reduce memory footprint
-    b = b.astype(np.float32) if type(b) == np.ndarray else b.todense().astype(np.float32)
-    b_gpu = cp.asarray(np.array(b))
+    A = A if isspmatrix_csc(A) else csc_matrix(A)
+    A_lu = splu(A, permc_spec='MMD_AT_PLUS_A')
 
-    cp_A_data = cp.asarray(A.data.ravel().astype(np.float32))
-    cp_A_incices = cp.asarray(A.indices.ravel())
-    cp_A_indptr = cp.asarray(A.indptr.ravel())
+    # no host-side cast or copy: the cast happens while filling the pinned buffer
+    b = b if type(b) == np.ndarray else b.toarray()
 
-    A_gpu = cupyx.scipy.sparse.csc_matrix((cp_A_data, cp_A_incices, cp_A_indptr), shape=A.shape)
+    stream = cp.cuda.Stream(non_blocking=True)
+    # cuSPARSE triangular solves expect a column-major right hand side
+    b_gpu, b_pinned = to_gpu_pinned(b, stream, dtype=A_lu.L.dtype, order='F')
+    A_lu_gpu = cupyx.scipy.sparse.linalg.SuperLU(A_lu)
+    stream.synchronize()
 
-    pu = []
-    for i in range(b.shape[-1]):
-        _pu = chol(A_gpu, b_gpu[:, i])[0]
-        pu.append(cp.asnumpy(_pu))
+    pu = cp.asnumpy(A_lu_gpu.solve(b_gpu)).astype(np.float32)
+
+    del b_gpu, A_lu_gpu
+    return pu
+
+
+def jacobi_preconditioner(A):
+    """ Diagonal (Jacobi) pre-conditioner, on the GPU if A is on the GPU. Each application is an element-wise product."""
+    inv_diag = 1 / A.diagonal()
+    on_gpu = not use_direct_solver_cupy and cp.get_array_module(inv_diag) is cp
+    _LinearOperator = cupyx.scipy.sparse.linalg.LinearOperator if on_gpu else LinearOperator
+    return _LinearOperator(A.shape,
+                           matvec=lambda x: x * inv_diag,
+                           matmat=lambda x: x * inv_diag[:, None],
+                           dtype=A.dtype)
+
+
+def solve_gpu_cg(A, b, tol=1.e-3, pre_conditioner=True, fused=False, max_workers=None):
+    """
+    This function solves the linear system of equations: Ax = b, by block conjugate gradient on the GPU.
+    A and all the columns of b are moved to the device once and solved together.
+    Parameters
+    ----------
+    A: Sparse csr matrix (NxN)
+    b: Sparse array or array (NxM)
+    tol: result tolerance
+    pre_conditioner: if false no pre-conditioner is used, otherwise the Jacobi pre-conditioner
+    fused: if true the whole cg runs in a single kernel (cg_columns), one thread block per label column.
+        It is meant for small launch bound grids, it has not been benchmarked against the block cg yet
+
+    returns x array (NxM)
+    -------
+    """
+    if use_direct_solver_cupy:
+        return direct_solver(A, b)
+
+    A = A if isspmatrix_csr(A) else csr_matrix(A)
+
+    def _solve(_b, x):
+        stream = cp.cuda.Stream(non_blocking=True)
+        with stream:
+            cp_A_data, data_pinned = to_gpu_pinned(A.data.ravel(), stream, dtype=np.float32)
+            cp_A_incices, indices_pinned = to_gpu_pinned(A.indices.ravel(), stream)
+            cp_A_indptr, indptr_pinned = to_gpu_pinned(A.indptr.ravel(), stream)
+            b_gpu, b_pinned = to_gpu_pinned(_b, stream, dtype=np.float32)
+
+            # csr layout is the one cuSPARSE SpMM is optimized for
+            A_gpu = cupyx.scipy.sparse.csr_matrix((cp_A_data, cp_A_incices, cp_A_indptr), shape=A.shape)
+
+            if fused:
+                x_gpu = cg_columns(A_gpu, b_gpu, tol=tol, pre_conditioner=pre_conditioner)
+            else:
+                M = jacobi_preconditioner(A_gpu) if pre_conditioner else None
+                x_gpu = block_cg(A_gpu, b_gpu, tol=tol, M=M)
+
+            # the device to host copy is asynchronous on stream, it is read only after the synchronization
+            x_host = cp.asnumpy(x_gpu, stream=stream)
+            stream.synchronize()
+
+        x[...] = x_host
 
-    del A_gpu, b_gpu
-    return np.array(pu, dtype=np.float32).T
+    return solve_partition_of_unity(_solve, b)
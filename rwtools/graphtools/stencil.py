@@ -0,0 +1,75 @@
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+from rwtools.graphtools.numba_cg import stencil_dot
+from rwtools.utils import seeds_bool_mask, sparse_pm
+
+
+class StencilLinearOperator(LinearOperator):
+    """
+    Matrix-free unseeded Laplacian Lu of a lattice graph.
+    The graph is stored as one weight per node and lattice offset, the products stream through the weights
+    and never read an index array. To keep the lattice layout the operator is defined on all the nodes:
+    the seeded rows are the identity, therefore solving with a right hand side that is zero on the seeds
+    gives the solution of Lu on the unseeded nodes (mask_u) and zero on the seeds.
+
+    Parameters
+    ----------
+    deltas (array K): raveled lattice offsets.
+    weights (array K x N): weights[k, i] is the weight of the edge (i, i + deltas[k]), zero if missing.
+    degree (array N): Sum of the weights incident to each node.
+    mask_u (array N): Bool mask of the unseeded nodes.
+    """
+    def __init__(self, deltas, weights, degree, mask_u):
+        self.deltas, self.weights, self.degree, self.mask_u = deltas, weights, degree, mask_u
+        super().__init__(dtype=weights.dtype, shape=(mask_u.shape[0], mask_u.shape[0]))
+
+    def diagonal(self):
+        return np.where(self.mask_u, self.degree, 1)
+
+    def _matmat(self, x):
+        # any memory layout is indexed directly, the column-major blocks of block_cg are not copied
+        x = np.asarray(x, dtype=self.dtype)
+        return stencil_dot(self.deltas, self.weights, self.degree, self.mask_u, x, np.empty_like(x))
+
+    def _matvec(self, x):
+        return self._matmat(x.reshape(-1, 1)).ravel()
+
+
+def stencil_lapu_b(graph, edges, seeds_mask):
+    """
+    Matrix-free counterpart of lap2lapu_bt: the Laplacian is never assembled.
+
+    Parameters
+    ----------
+    graph (array 2 x d): Graph matrix of a lattice, as returned by make2d_lattice_graph or make3d_lattice_graph.
+    edges (array d): Edge weights.
+    seeds_mask (array): Seeds mask, labels at seeds position and zeros everywhere else.
+
+    Returns
+    -------
+    Lu (StencilLinearOperator): unseeded Laplacian, defined on all the lattice nodes.
+    b (array): right hand side Bt pm of the random walker system, defined on all the lattice nodes.
+    """
+    num_nodes = seeds_mask.size
+    g0, g1 = graph.min(0), graph.max(0)
+    deltas, k = np.unique(g1 - g0, return_inverse=True)
+
+    weights = np.zeros((deltas.shape[0], num_nodes), dtype=np.float64)
+    weights[k, g0] = edges
+    degree = np.bincount(g0, edges, num_nodes) + np.bincount(g1, edges, num_nodes)
+
+    mask_u = seeds_bool_mask(seeds_mask.ravel())
+    Lu = StencilLinearOperator(deltas, weights, degree, mask_u)
+
+    # Bt pm = W[u][:, s] pm, the seeds probabilities are spread to their unseeded neighbours
+    pm = sparse_pm(seeds_mask).toarray()
+    pm_full = np.zeros((num_nodes, pm.shape[-1]), dtype=np.float64)
+    pm_full[~mask_u] = pm
+
+    b = np.zeros_like(pm_full)
+    for i in range(pm.shape[-1]):
+        b[:, i] = np.bincount(g0, edges * pm_full[g1, i], num_nodes) + np.bincount(g1, edges * pm_full[g0, i], num_nodes)
+
+    b[~mask_u] = 0
+    return Lu, b
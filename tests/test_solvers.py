@@ -0,0 +1,168 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+from scipy.sparse import csr_matrix, diags, eye, kron
+from scipy.sparse.linalg import spsolve
+
+from rwtools.graphtools.graphtools import adjacency2laplacian, compute_randomwalker, graph2adjacency, image2edges, \
+    make2d_lattice_graph
+from rwtools.graphtools.numba_cg import ell_dot, to_ell
+from rwtools.graphtools.solvers import block_cg, direct_solver, mg_solver, solve_amg, solve_cg, sp_cg
+from rwtools.graphtools.stencil import stencil_lapu_b
+from rwtools.utils import lap2lapu_bt, sparse_pm
+
+
+def laplacian_1d(n):
+    return csr_matrix(diags([-np.ones(n - 1), 2.1 * np.ones(n), -np.ones(n - 1)], [-1, 0, 1]))
+
+
+def laplacian_2d(n, seed=0):
+    # 4-connected n x n lattice with random edge weights, shifted to be positive definite
+    rs = np.random.RandomState(seed)
+    edges = kron(eye(n), diags([1], [1], (n, n))) + kron(diags([1], [1], (n, n)), eye(n))
+    W = csr_matrix(edges)
+    W.data = rs.rand(W.nnz) + 1e-2
+    W = W + W.T
+    return csr_matrix(diags(np.asarray(W.sum(1)).ravel() + 1e-2) - W)
+
+
+def blobs_problem(n=32):
+    # smooth random image with four seeded corners, default beta
+    image = gaussian_filter(np.random.RandomState(0).rand(n, n), 2)
+    seeds_mask = np.zeros((n, n), dtype=np.int64)
+    for label, (i, j) in enumerate([(1, 1), (1, 3), (3, 1), (3, 3)]):
+        seeds_mask[i * n // 4 - 1:i * n // 4 + 2, j * n // 4 - 1:j * n // 4 + 2] = label + 1
+
+    graph = make2d_lattice_graph(size=(n, n), offsets=((1, 0), (0, 1)))
+    edges = image2edges(image, graph, 130, divide_by_std=True).astype(np.float64)
+    return edges, graph, seeds_mask
+
+
+class TestSolvers:
+    def test_block_cg(self):
+        A = laplacian_1d(64)
+        b = np.random.RandomState(0).rand(64, 3)
+        b[:, 1] = 0
+
+        x = block_cg(A, b, tol=1e-8)
+        _x = np.stack([spsolve(A, b[:, i]) for i in range(b.shape[-1])], axis=1)
+        assert np.allclose(x, _x, atol=1e-6)
+
+    def test_direct_solver(self):
+        # the random walker laplacian is single precision, the factorization is not
+        A = laplacian_2d(16)
+        b = csr_matrix(np.random.RandomState(0).rand(A.shape[0], 3))
+
+        x = direct_solver(csr_matrix(A, dtype=np.float32), b)
+        assert np.allclose(x, spsolve(csr_matrix(A, dtype=np.float32).asfptype(), b).toarray(), atol=1e-6)
+
+    def test_sp_cg(self):
+        # sparse right hand side with an empty column, as for a label without seeds next to the unseeded nodes
+        A = laplacian_2d(16)
+        b = np.random.RandomState(0).rand(A.shape[0], 3)
+        b[:, 1] = 0
+
+        x = sp_cg(A, csr_matrix(b), tol=1e-10)
+        _x = np.stack([spsolve(A, b[:, i]) for i in range(b.shape[-1])], axis=1)
+        assert np.allclose(x, _x, atol=1e-6)
+
+    def test_ell(self):
+        # corner, border and interior nodes have rows of different lengths, the padding is exercised
+        A = laplacian_2d(16)
+        x = np.random.RandomState(0).rand(A.shape[0])
+
+        values, columns = to_ell(A.data, A.indices, A.indptr)
+        assert values.shape == (A.shape[0], 5)
+        assert np.allclose(ell_dot(values, columns, x, np.empty_like(x)), A @ x)
+
+        b = np.random.RandomState(1).rand(A.shape[0], 3)
+        pu = solve_cg(A, b, tol=1e-6)
+        _x = np.stack([spsolve(A, b[:, i]) for i in range(b.shape[-1] - 1)], axis=1)
+        assert np.allclose(pu[:, :-1], _x, rtol=1e-3, atol=1e-3 * np.abs(_x).max())
+        assert np.allclose(pu[:, -1], 1 - _x.sum(axis=1), atol=1e-3 * np.abs(_x).max())
+
+    def test_cg_mg_accuracy(self):
+        pytest.importorskip("pyamg")
+        edges, graph, seeds_mask = blobs_problem()
+
+        p = compute_randomwalker(edges, graph, seeds_mask, solving_mode="cg_mg")
+        _p = compute_randomwalker(edges, graph, seeds_mask, solving_mode="direct")
+        assert np.abs(p - _p).max() < 2e-2
+        assert p.min() > -1e-2 and p.max() < 1 + 1e-2
+
+    def test_cg_stencil_accuracy(self):
+        edges, graph, seeds_mask = blobs_problem()
+
+        p = compute_randomwalker(edges, graph, seeds_mask, solving_mode="cg_stencil")
+        _p = compute_randomwalker(edges, graph, seeds_mask, solving_mode="direct")
+        assert np.abs(p - _p).max() < 2e-2
+        assert np.allclose(p.sum(axis=-1), 1, atol=1e-5)
+
+    def test_cg_columns(self):
+        cp = pytest.importorskip("cupy")
+        try:
+            has_device = cp.cuda.runtime.getDeviceCount() > 0
+        except Exception:
+            has_device = False
+        if not has_device:
+            pytest.skip("no CUDA device")
+
+        from cupyx.scipy.sparse import csr_matrix as cp_csr_matrix
+        from rwtools.graphtools.cg_cupy import cg_columns
+
+        A = laplacian_2d(16)
+        b = np.random.RandomState(0).rand(A.shape[0], 3)
+
+        x = cg_columns(cp_csr_matrix(A), cp.asarray(b), tol=1e-5)
+        _x = block_cg(A, b, tol=1e-8)
+        assert np.allclose(cp.asnumpy(x), _x, rtol=1e-3, atol=1e-3 * np.abs(_x).max())
+
+    def test_stencil(self):
+        # the diagonal offsets check the raveled offsets and the boundaries in both directions
+        n = 16
+        seeds_mask = np.zeros((n, n), dtype=np.int64)
+        seeds_mask[2, 3], seeds_mask[n - 1, 0], seeds_mask[8, n - 1] = 1, 2, 3
+        graph = make2d_lattice_graph(size=(n, n), offsets=((1, 0), (0, 1), (1, 1), (1, -1)))
+        edges = image2edges(np.random.RandomState(0).rand(n, n), graph, 10, divide_by_std=True)
+
+        L = adjacency2laplacian(graph2adjacency(graph, edges), mode=0)
+        Lu, Bt = lap2lapu_bt(L, seeds_mask)
+        _Lu, b = stencil_lapu_b(graph, edges, seeds_mask)
+        assert np.allclose(b[_Lu.mask_u], Bt.dot(sparse_pm(seeds_mask)).toarray())
+        assert np.all(b[~_Lu.mask_u] == 0)
+
+        x = np.asfortranarray(np.random.RandomState(1).rand(Lu.shape[0], 2))
+        x_full = np.zeros((n * n, 2), order='F')
+        x_full[_Lu.mask_u] = x
+        assert np.allclose((_Lu @ x_full)[_Lu.mask_u], Lu @ x)
+
+    @pytest.mark.parametrize("max_workers", [None, 3])
+    def test_amg(self, max_workers):
+        pytest.importorskip("pyamg")
+        A = laplacian_2d(32)
+        b = np.random.RandomState(0).rand(A.shape[0], 5)
+
+        pu = solve_amg(A, b, tol=1e-8, max_workers=max_workers)
+        _x = direct_solver(A, b)[:, :-1]
+        assert np.allclose(pu[:, :-1], _x, atol=1e-4 * np.abs(_x).max())
+        assert np.allclose(pu[:, -1], 1 - _x.sum(axis=1), atol=1e-4 * np.abs(_x).max())
+
+    def test_mg_solver_cache(self):
+        pyamg = pytest.importorskip("pyamg")
+        A, _A = laplacian_2d(32, seed=0), laplacian_2d(32, seed=1)
+        b = np.random.RandomState(0).rand(A.shape[0])
+
+        mg_solver(A)
+        ml = mg_solver(_A)  # same sparsity, different weights: the cached interpolation is reused
+        level = ml.levels[0]
+        assert np.allclose((ml.levels[1].A - level.R @ _A @ level.P).toarray(), 0)
+
+        _ml = pyamg.ruge_stuben_solver(_A, coarse_solver='gauss_seidel')
+        x, _x = ml.solve(b, tol=1e-10, accel='cg'), _ml.solve(b, tol=1e-10, accel='cg')
+        assert np.allclose(x, _x, atol=1e-6)
+        assert np.allclose(x, spsolve(_A, b), atol=1e-6)
+
+        # the cache is keyed by dtype, a single precision A gets a single precision hierarchy
+        ml = mg_solver(csr_matrix(_A, dtype=np.float32))
+        assert all(level.A.dtype == np.float32 for level in ml.levels)
+        assert all(level.P.dtype == np.float32 for level in ml.levels[:-1])